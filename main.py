@@ -2,37 +2,56 @@ import os
 import json
 import logging
 from pathlib import Path
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException, Depends
 from pydantic import BaseModel
-import mysql.connector
-from mysql.connector import pooling
+import asyncmy
+from asyncmy.cursors import DictCursor
+from asyncmy.errors import MySQLError
 import hashlib
+import hmac
 
 # ----------------- Logging Setup -----------------
 logging.basicConfig(level=logging.INFO)
-app = FastAPI(title="Madox Proxy")
 
 # ----------------- Load Queries -----------------
 QUERIES_PATH = Path(__file__).parent / "queries.json"
 with open(QUERIES_PATH, "r", encoding="utf-8") as f:
     QUERY_DICT = json.load(f)
 
+# Codes clients may call, each with its own branch in run_query; other QUERY_DICT entries are internal
+PUBLIC_CODES = {"001", "003"}
+
 # ----------------- DB Connection Pool -----------------
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "25"))
+if DB_POOL_SIZE < 1:
+    raise ValueError(f"DB_POOL_SIZE must be at least 1, got {DB_POOL_SIZE}")
 dbconfig = {
     "host": os.getenv("DB_HOST"),
     "user": os.getenv("DB_USER"),
     "password": os.getenv("DB_PASS"),
     "database": os.getenv("DB_NAME"),
-    "pool_name": "proxy_pool",
-    "pool_size": 5
+    "minsize": min(5, DB_POOL_SIZE),
+    "maxsize": DB_POOL_SIZE,
+    "autocommit": True,
+    "pool_recycle": 1800  # reconnect before the server's idle timeout drops the socket
 }
-connection_pool = pooling.MySQLConnectionPool(**dbconfig)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.pool = await asyncmy.create_pool(**dbconfig)
+    yield
+    app.state.pool.close()
+    await app.state.pool.wait_closed()
+
+app = FastAPI(title="Madox Proxy", lifespan=lifespan)
 
 # ----------------- Security -----------------
 API_KEY = os.getenv("API_KEY")
+API_KEY_BYTES = (API_KEY or "").strip().encode("utf-8")
 def verify_api_key(request: Request):
-    sent_key = request.headers.get("x-api-key")
-    if not API_KEY or not sent_key or sent_key.strip() != API_KEY.strip():
+    sent_key = (request.headers.get("x-api-key") or "").strip().encode("utf-8")
+    if not API_KEY_BYTES or not hmac.compare_digest(sent_key, API_KEY_BYTES):
         raise HTTPException(status_code=403, detail="Forbidden")
 
 # ----------------- Request Model -----------------
@@ -46,59 +65,58 @@ def double_hash(username: str, password_hash: str) -> str:
     salted = f"{username}:{password_hash}"
     return hashlib.sha256(salted.encode("utf-8")).hexdigest()
 
+async def abort_transaction(conn):
+    # The pool does not reset sessions on release, so never hand back an open transaction
+    try:
+        await conn.rollback()
+    except BaseException:
+        conn.close()  # a closed connection is dropped by the pool instead of reused
+
 # ----------------- Single Query Endpoint -----------------
 @app.post("/query", dependencies=[Depends(verify_api_key)])
-def run_query(data: QueryRequest):
-    conn = connection_pool.get_connection()
-    cursor = conn.cursor(dictionary=True)
-    try:
-        conn.start_transaction()
-
-        # ----------------- LOGIN -----------------
-        if data.query_code == "001":
-            cursor.execute(QUERY_DICT["001"], (data.username,))
-            user = cursor.fetchone()
-            if not user:
-                conn.rollback()
-                return {"code": "002"}  # invalid credentials
-
-            hashed_pw = double_hash(data.username, data.password)
-            if hashed_pw != user["password_hash"]:
-                conn.rollback()
-                return {"code": "002"}  # invalid credentials
-
-            cursor.execute(QUERY_DICT["002"], (user["id"],))
-            if cursor.rowcount == 0:
-                conn.rollback()
-                return {"code": "001"}  # simultaneous login limit exceeded
-
-            conn.commit()
-            return {"code": "000"}  # login successful
-
-        # ----------------- LOGOUT -----------------
-        elif data.query_code == "003":
-            cursor.execute("SELECT id, status FROM users WHERE username=%s FOR UPDATE", (data.username,))
-            user = cursor.fetchone()
-            if not user:
-                conn.rollback()
-                return {"status": "user_not_found"}
-
-            cursor.execute(QUERY_DICT["003"], (user["id"],))
-            conn.commit()
-            return {"status": "ok"}
-
-        # ----------------- Unknown Query -----------------
-        else:
-            conn.rollback()
-            return {"status": "unknown_query"}
-
-    except mysql.connector.Error as e:
-        conn.rollback()
-        logging.error(f"DB Error: {e}")
-        raise HTTPException(status_code=500, detail="Database error")
-    finally:
-        cursor.close()
-        conn.close()
+async def run_query(data: QueryRequest):
+    # ----------------- Unknown Query -----------------
+    if data.query_code not in PUBLIC_CODES:
+        return {"status": "unknown_query"}
+
+    hashed_pw = double_hash(data.username, data.password) if data.query_code == "001" else None
+
+    async with app.state.pool.acquire() as conn:
+        async with conn.cursor(DictCursor) as cursor:
+            try:
+                # ----------------- LOGIN -----------------
+                if data.query_code == "001":
+                    # Credential check and session increment in one atomic statement
+                    await cursor.execute(QUERY_DICT["001"], (data.username, hashed_pw))
+                    if cursor.rowcount:
+                        return {"code": "000"}  # login successful
+
+                    # Only failed logins pay a second round-trip to tell the cases apart
+                    await cursor.execute(QUERY_DICT["002"], (data.username, hashed_pw))
+                    if not await cursor.fetchone():
+                        return {"code": "002"}  # invalid credentials
+                    return {"code": "001"}  # simultaneous login limit exceeded
+
+                # ----------------- LOGOUT -----------------
+                elif data.query_code == "003":
+                    try:
+                        await conn.begin()
+                        await cursor.execute("SELECT id, status FROM users WHERE username=%s FOR UPDATE", (data.username,))
+                        user = await cursor.fetchone()
+                        if not user:
+                            await conn.rollback()
+                            return {"status": "user_not_found"}
+
+                        await cursor.execute(QUERY_DICT["003"], (user["id"],))
+                        await conn.commit()
+                        return {"status": "ok"}
+                    except BaseException:
+                        await abort_transaction(conn)
+                        raise
+
+            except MySQLError as e:
+                logging.error(f"DB Error: {e}")
+                raise HTTPException(status_code=500, detail="Database error")
 
 # ----------------- Health Check -----------------
 @app.get("/health")